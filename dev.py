@@ -1,115 +1,132 @@
+import hashlib
+import logging
 from enum import Enum
 from typing import Dict, List, Optional
 
-from elasticsearch import Elasticsearch
+import orjson
+from cachetools import TTLCache
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer
 from fastapi import Depends, FastAPI, HTTPException, Path, Query, Request
-from starlette.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response
 
 from development.loaddata import create_sample_index, load_sample_data
 from fastapi_elasticsearch import ElasticsearchAPIQueryBuilder
-from development.utils import wait_elasticsearch
+from development.utils import ORJSON_SERIALIZERS, wait_elasticsearch
 
-es = Elasticsearch(
-    ["http://elastic-dev:9200"]
+# Show the sample data loading summary, the rest stays at warnings.
+logging.basicConfig()
+logging.getLogger("development").setLevel(logging.INFO)
+
+elasticsearch_hosts = ["http://elastic-dev:9200"]
+index_name = "sample-data"
+
+es_options = dict(
+    connections_per_node=64,
+    http_compress=True,
+    retry_on_timeout=True,
+    sniff_on_start=False
 )
 
-wait_elasticsearch(es)
+es = AsyncElasticsearch(elasticsearch_hosts,
+                        serializers=ORJSON_SERIALIZERS,
+                        **es_options)
+
+
+class RawJSONSerializer(OrjsonSerializer):
+    def loads(self, data: bytes) -> bytes:
+        return data
+
+
+# Client that hands back the response body exactly as Elasticsearch sent it,
+# for endpoints that forward the response without looking into it.
+raw_es = AsyncElasticsearch(
+    elasticsearch_hosts,
+    serializers={"application/json": RawJSONSerializer()},
+    **es_options
+)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+
+def seed_sample_index():
+    # Short lived client used only to wait for the cluster and seed the index.
+    bootstrap_es = Elasticsearch(elasticsearch_hosts,
+                                 serializers=ORJSON_SERIALIZERS)
+    try:
+        wait_elasticsearch(bootstrap_es)
+        if not bootstrap_es.indices.exists(index=index_name):
+            # Creating the index is atomic, so when several workers start
+            # together only the one that created it loads the data.
+            resp = create_sample_index(bootstrap_es, index_name)
+            if resp.body.get("acknowledged"):
+                load_sample_data(bootstrap_es, index_name)
+    finally:
+        bootstrap_es.close()
 
-index_name = "sample-data"
-if not es.indices.exists(index=index_name):
-    create_sample_index(es, index_name)
-    load_sample_data(es, index_name)
 
-app = FastAPI()
+@app.on_event("startup")
+async def seed_elasticsearch():
+    await run_in_threadpool(seed_sample_index)
+
+
+@app.on_event("shutdown")
+async def close_elasticsearch():
+    await es.close()
+    await raw_es.close()
+
 
 query_builder = ElasticsearchAPIQueryBuilder()
 
 
-@query_builder.filter()
-def filter_items():
-    return {
-        "term": {
-            "join_field": "item"
-        }
+# Constant query parts are built once and shared between requests, the
+# query builder only reads them.
+_HIGHLIGHT_FIELDS = {
+    "name": {
+        "fragment_size": 256,
+        "number_of_fragments": 1
+    },
+    "content": {
+        "fragment_size": 256,
+        "number_of_fragments": 1
     }
+}
 
 
 @query_builder.filter()
-def filter_category(category: Optional[List[str]] = Query([],
+def filter_category(category: Optional[List[str]] = Query(None,
                                                           description="Category name to filter results.")):
+    if not category:
+        return None
     return {
         "terms": {
             "category": category
         }
-    } if len(category) > 0 else None
+    }
 
 
 @query_builder.matcher()
 def match_fields(q: Optional[str] = Query(None,
-                                          description="Query to match the document text.")):
-    return {
+                                          description="Query to match the document text."),
+                 fuzzy: bool = Query(True,
+                                     description="Allow typos in queries with at least 4 characters.")):
+    if not q:
+        return None
+    matcher = {
         "multi_match": {
             "query": q,
-            "fuzziness": "AUTO",
             "fields": [
                 "name^2",
+                "content",
             ]
         }
-    } if q is not None else None
-
-
-@query_builder.matcher()
-def match_fragments(q: Optional[str] = Query(None,
-                                             description="Query to match the document text."),
-                    h: bool = Query(False,
-                                    description="Highlight matched text and inner hits.")):
-    if q is not None:
-        matcher = {
-            "has_child": {
-                "type": "fragment",
-                "score_mode": "max",
-                "query": {
-                    "bool": {
-                        "minimum_should_match": 1,
-                        "should": [
-                            {
-                                "match": {
-                                    "content": {
-                                        "query": q,
-                                        "fuzziness": "auto"
-                                    }
-                                }
-                            },
-                            {
-                                "match_phrase": {
-                                    "content": {
-                                        "query": q,
-                                        "slop": 3,
-                                        "boost": 50
-                                    }
-                                }
-                            },
-                        ]
-                    }
-                }
-            }
-        }
-        if h:
-            matcher["has_child"]["inner_hits"] = {
-                "size": 1,
-                "_source": "false",
-                "highlight": {
-                    "fields": {
-                        "content": {
-                            "fragment_size": 256,
-                            "number_of_fragments": 1
-                        }
-                    }
-                }
-            }
-        return matcher
-    else:
-        return None
+    }
+    # Fuzzy expansion of very short terms matches a large part of the term
+    # dictionary, so it is only enabled for longer queries.
+    if fuzzy and len(q) >= 4:
+        matcher["multi_match"]["fuzziness"] = "AUTO"
+    return matcher
 
 
 class Direction(str, Enum):
@@ -119,9 +136,11 @@ class Direction(str, Enum):
 
 @query_builder.sorter()
 def sort_by(direction: Optional[Direction] = Query(None)):
+    if direction is None:
+        return None
     return {
         "name": direction
-    } if direction is not None else None
+    }
 
 
 class AggField(Enum):
@@ -131,6 +150,8 @@ class AggField(Enum):
 @query_builder.agg()
 def agg_field(agg_field: Optional[AggField] = Query(None,
                                                description="Field to aggregate.")):
+    if agg_field is None:
+        return None
     return {
         f"agg_{agg_field.value}": {
             "terms": {
@@ -138,32 +159,47 @@ def agg_field(agg_field: Optional[AggField] = Query(None,
                 "size": 10
             }
         }
-    } if agg_field is not None else None
+    }
 
 
 @query_builder.highlighter()
 def highlight(q: Optional[str] = Query(None,
                                        description="Query to match the document text."),
               h: bool = Query(False,
-                              description="Highlight matched text and inner hits.")):
-    return {
-        "name": {
-            "fragment_size": 256,
-            "number_of_fragments": 1
-        }
-    } if q is not None and h else None
+                              description="Highlight matched text.")):
+    if not (q and h):
+        return None
+    return _HIGHLIGHT_FIELDS
+
+
+# Hits only need these fields, highlights are returned separately.
+search_source = ["name", "category"]
+
+# Raw /search responses, keyed by a digest of the query body.
+search_cache = TTLCache(maxsize=1024, ttl=30)
+
+
+def clear_search_cache():
+    # Must be called after writing to the index.
+    search_cache.clear()
 
 
 @app.get("/search")
-async def search(query_body: Dict = Depends(query_builder.build())) -> JSONResponse:
-    return es.search(
-        body=query_body,
-        index=index_name
-    )
+async def search(query_body: Dict = Depends(query_builder.build(source=search_source, track_total_hits=False))):
+    key = hashlib.blake2b(orjson.dumps(query_body, option=orjson.OPT_SORT_KEYS),
+                          digest_size=16).digest()
+    content = search_cache.get(key)
+    if content is None:
+        resp = await raw_es.search(
+            body=query_body,
+            index=index_name
+        )
+        content = search_cache[key] = resp.body
+    return Response(content=content, media_type="application/json")
 
 
 @app.get("/search/debug")
-async def search_debug(query_body: Dict = Depends(query_builder.build())) -> JSONResponse:
+async def search_debug(query_body: Dict = Depends(query_builder.build(source=search_source, track_total_hits=False))):
     return query_body
 
 
@@ -177,12 +213,13 @@ def filter_document(doc_id: str = Path(title="The id of the document.")):
     }
 
 
-doc_query_builder.add_matcher(match_fragments)
+doc_query_builder.add_matcher(match_fields)
+doc_query_builder.add_highlighter(highlight)
 
 
 @app.get("/document/{doc_id}")
 async def get_document(query_body: Dict = Depends(doc_query_builder.build())):
-    resp = es.search(
+    resp = await es.search(
         body=query_body,
         index=index_name
     )
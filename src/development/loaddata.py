@@ -1,60 +1,63 @@
+import logging
+import time
+
 import lorem
 import names
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+
+logger = logging.getLogger(__name__)
 
 
 def create_sample_index(es: Elasticsearch, index_name: str):
-    return es.indices.create(
+    return es.options(ignore_status=400).indices.create(
         index=index_name,
-        ignore=400,
-        body={
-            "mappings": {
-                "properties": {
-                    "name": {
-                        "type": "text",
-                        "fields": {
-                            "keyword": {
-                                "type": "keyword"
-                            }
-                        }
-                    },
-                    "category": {
-                        "type": "keyword"
-                    },
-                    "content": {
-                        "type": "text"
-                    },
-                    "join_field": {
-                        "type": "join",
-                        "relations": {
-                            "item": "fragment"
+        mappings={
+            "properties": {
+                "name": {
+                    "type": "text",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
+                },
+                "category": {
+                    "type": "keyword"
+                },
+                "content": {
+                    "type": "text"
                 }
             }
         }
     )
 
 
-def load_sample_data(es: Elasticsearch, index_name: str, num_docs=10):
+def sample_data_actions(index_name: str, num_docs=10):
     for i in range(num_docs):
-        body = {
-            "name": names.get_full_name(),
-            "category": f"person_type_{i % 2}",
-            "join_field": "item",
-        }
-        print(f"Creating sample data {body}.")
-        res = es.index(index=index_name, routing=1, document=body)
-        doc_id = res["_id"]
-        print(f"Created with id {doc_id}.")
-        fragment_body = {
-            "content": lorem.paragraph(),
-            "join_field": {
-                "name": "fragment",
-                "parent": doc_id,
+        yield {
+            "_index": index_name,
+            "_source": {
+                "name": names.get_full_name(),
+                "category": f"person_type_{i % 2}",
+                "content": [lorem.paragraph()],
             },
         }
-        print(f"Creating sample fragment data {fragment_body}.")
-        res = es.index(index=index_name, routing=1, document=fragment_body)
-        doc_id = res["_id"]
-        print(f"Created with id {doc_id}.")
+
+
+def load_sample_data(es: Elasticsearch, index_name: str, num_docs=10):
+    start = time.perf_counter()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    success = 0
+    for ok, item in parallel_bulk(es.options(request_timeout=60),
+                                  sample_data_actions(index_name, num_docs),
+                                  thread_count=4,
+                                  chunk_size=250,
+                                  queue_size=4):
+        if not ok:
+            raise RuntimeError(item)
+        if debug:
+            logger.debug("Indexed %s.", item)
+        success += 1
+    logger.info("Indexed %d sample documents in %.1fs.",
+                success, time.perf_counter() - start)
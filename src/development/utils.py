@@ -1,23 +1,38 @@
 import logging
+import random
 import time
 
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import NdjsonSerializer, OrjsonSerializer
 
 
 def wait_elasticsearch(es: Elasticsearch,
                        interval=2000,
                        max_retries=30,
-                       params=None,
                        headers=None):
-    attempts = 0
-    while attempts < max_retries:
-        try:
-            resp = es.info(params=params, headers=headers)
+    # Retries back off exponentially from 50ms up to `interval` ms. ping()
+    # is a HEAD request, so no cluster info has to be sent and parsed.
+    client = es.options(headers=headers) if headers else es
+    delay = 50
+    for attempt in range(max_retries):
+        if client.ping():
             logging.info("Connected to elasticsearch.")
-            return resp
-        except:
-            logging.warn(
-                f"Could not connect to Elasticsearch. Retry will occur in {interval}ms.")
-            attempts += 1
-            time.sleep(interval/1000)
-    raise Exception("Could not connect to Elasticsearch.")
+            return True
+        wait = min(delay, interval) + random.uniform(0, 50)
+        logging.warning(
+            f"Could not connect to Elasticsearch. Retry {attempt + 1} will occur in {wait:.0f}ms.")
+        time.sleep(wait/1000)
+        delay *= 2
+    raise ConnectionError("Could not connect to Elasticsearch.")
+
+
+class OrjsonNdjsonSerializer(OrjsonSerializer, NdjsonSerializer):
+    pass
+
+
+# Serializers for Elasticsearch clients, covering the NDJSON bodies sent by
+# the bulk helpers as well as regular requests and responses.
+ORJSON_SERIALIZERS = {
+    "application/json": OrjsonSerializer(),
+    "application/x-ndjson": OrjsonNdjsonSerializer(),
+}
@@ -1,2 +1,3 @@
 __version__ = "0.6.0"
-from fastapi_elasticsearch.api import (ElasticsearchAPIQueryBuilder)
+from fastapi_elasticsearch.api import (ElasticsearchAPIQueryBuilder,
+                                       build_msearch_body)
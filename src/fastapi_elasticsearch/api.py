@@ -1,74 +1,182 @@
-from typing import Callable, Dict, List, Optional, Union
+import inspect
+from collections import Counter
+from typing import (Callable, Dict, Hashable, Iterable, List, Optional, Tuple,
+                    Union)
+from weakref import WeakKeyDictionary, WeakValueDictionary
 import forge
-from fastapi import Depends, Query
+from fastapi import Depends, Query, params
 from fastapi.dependencies.utils import analyze_param, get_typed_signature
 from fastapi.types import DecoratedCallable
 
 
-def combine(functions: List[Callable]):
-    args_list = []
+function_args_cache: "WeakKeyDictionary[Callable, Tuple[forge.FParameter, ...]]" = WeakKeyDictionary()
+
+
+def function_args(func: Callable) -> Tuple[forge.FParameter, ...]:
+    # Shared by every builder, a callback used by several builders or
+    # routes is only inspected once, for as long as the callback lives.
+    try:
+        args = function_args_cache.get(func)
+    except TypeError:
+        # Callables that cannot be weakly referenced are not cached.
+        return analyze_function_args(func)
+    if args is None:
+        args = function_args_cache[func] = analyze_function_args(func)
+    return args
+
+
+def analyze_function_args(func: Callable) -> Tuple[forge.FParameter, ...]:
+    signature = get_typed_signature(func)
+    args = []
+    for param_name, param in signature.parameters.items():
+        type_annotation, depends, param_field = analyze_param(
+            param_name=param_name,
+            annotation=param.annotation,
+            value=param.default,
+            is_path_param=False,
+        )
+        if depends is not None:
+            # Sub-dependencies are passed through untyped, FastAPI resolves
+            # them once per request even when several callbacks declare them.
+            args.append(forge.pok(name=param_name, default=depends))
+        else:
+            args.append(forge.pok(
+                name=param_name,
+                type=param_field.outer_type_,
+                default=param.default
+            ))
+    return tuple(args)
+
+
+def compile_combined(funcs: List[Tuple[Callable, Optional[List[str]]]],
+                     arg_names: List[str]) -> Tuple[Callable, Dict[str, Callable]]:
+    # Callables without argument names are passed in as sub-dependencies.
+    prefix = "_combined"
+    while any(name.startswith(prefix) for name in arg_names):
+        prefix = "_" + prefix
+    namespace = {}
+    results = {}
+    dependencies = {}
+    lines = []
+    for func, func_arg_names in funcs:
+        if id(func) not in results:
+            i = len(results)
+            results[id(func)] = f"{prefix}_result_{i}"
+            if func_arg_names is None:
+                dependencies[f"{prefix}_result_{i}"] = func
+                continue
+            namespace[f"{prefix}_{i}"] = func
+            func_kwargs = ", ".join(f"{name}={name}" for name in func_arg_names)
+            lines.append(
+                f"    {prefix}_result_{i} = {prefix}_{i}({func_kwargs})\n")
+    values = ", ".join(results[id(func)] for func, _ in funcs)
+    source = (f"def combined_functions({', '.join([*arg_names, *dependencies])}):\n"
+              + "".join(lines)
+              + f"    return [r for r in ({values},) if r is not None]\n")
+    exec(source, namespace)
+    return namespace["combined_functions"], dependencies
+
+
+def combine(functions: List[Callable], dependencies: Iterable[Callable] = ()):
+    dependency_ids = {id(func) for func in dependencies}
     funcs = []
     combined_args = {}
     for func in functions:
         if not callable(func):
             raise TypeError("Arguments must be callable")
-        signature = get_typed_signature(func)
-        signature_params = signature.parameters
-        func_arg_names = set({})
-        for param_name, param in signature_params.items():
-            type_annotation, depends, param_field = analyze_param(
-                param_name=param_name,
-                annotation=param.annotation,
-                value=param.default,
-                is_path_param=False,
-            )
-            arg = forge.pok(
-                name=param_name,
-                type=param_field.outer_type_,
-                default=param.default
-            )            
-            if param_name in combined_args:
-                current_arg = combined_args[param_name]
-                if str(arg) != str(current_arg):
-                    raise TypeError(
-                        f"{arg} and {current_arg} are incompatible.")
+        if id(func) in dependency_ids:
+            funcs.append((func, None))
+            continue
+        func_args = function_args(func)
+        for arg in func_args:
+            # Defaults such as Query(None) are compared by their str(), two
+            # separately declared but identical ones are compatible.
+            # Sub-dependencies are compared by the dependency itself.
+            if isinstance(arg.default, params.Depends):
+                key = (arg.default.dependency, arg.default.use_cache)
             else:
-                combined_args[param_name] = arg
-            func_arg_names.add(param_name)
-            args_list.append(arg)
-        funcs.append((func, func_arg_names))
-
-    def combined_functions(*args, **kwargs):
-        result = []
-        for (func, arg_names) in funcs:
-            func_kwargs = dict((k, kwargs[k]) for k in arg_names)
-            result.append(func(*args, **func_kwargs))
-        return result
-
-    new_args = tuple(combined_args.values())
+                key = (arg.type, str(arg.default))
+            current = combined_args.get(arg.name)
+            if current is None:
+                combined_args[arg.name] = (arg, key)
+            elif current[1] != key:
+                raise TypeError(
+                    f"{arg} and {current[0]} are incompatible.")
+        funcs.append((func, [arg.name for arg in func_args]))
+
+    combined_functions, dependency_args = compile_combined(
+        funcs, list(combined_args))
+    new_args = [arg for arg, _ in combined_args.values()]
+    new_args.extend(forge.pok(name=name, default=Depends(func))
+                    for name, func in dependency_args.items())
     return forge.sign(*new_args)(combined_functions)
 
 
+def merge_dicts(dicts: Iterable[Optional[Dict]]) -> Dict:
+    merged = {}
+    for d in dicts:
+        if d is not None:
+            merged.update(d)
+    return merged
+
+
+def build_msearch_body(bodies: List[Dict], index: str = None) -> List[Dict]:
+    header = {} if index is None else {"index": index}
+    searches = []
+    for body in bodies:
+        searches.append(header)
+        searches.append(body)
+    return searches
+
+
 class ElasticsearchAPIQueryBuilder():
     def __init__(self,
                  *,
                  size: int = None,
                  start_from: int = None,
-                 filters: List[Callable] = [],
-                 matchers: List[Callable] = [],
-                 highlighters: List[Callable] = [],
-                 sorters: List[Callable] = [],
-                 aggregations: List[Callable] = []):
-        self.build_search_body = self.default_build_search_body
+                 filters: List[Callable] = None,
+                 matchers: List[Callable] = None,
+                 highlighters: List[Callable] = None,
+                 sorters: List[Callable] = None,
+                 aggregations: List[Callable] = None,
+                 build_search_body: Callable = None):
+        self.build_search_body = self.default_build_search_body \
+            if build_search_body is None else build_search_body
         self.size_func = self.fixed_size(
             size) if size is not None else self.default_size
         self.start_from_func = self.fixed_start_from(
             start_from) if start_from is not None else self.default_start_from
-        self.filters = filters.copy()
-        self.matchers = matchers.copy()
-        self.highlighters = highlighters.copy()
-        self.sorters = sorters.copy()
-        self.aggregations = aggregations.copy()
+        self.filters = list(filters) if filters else []
+        self.matchers = list(matchers) if matchers else []
+        self.highlighters = list(highlighters) if highlighters else []
+        self.sorters = list(sorters) if sorters else []
+        self.aggregations = list(aggregations) if aggregations else []
+        self.depends_cache: "WeakValueDictionary[Callable, params.Depends]" = WeakValueDictionary()
+        self.combined_cache: Dict[Tuple[Tuple[Callable, ...], ...], Callable] = {}
+
+    def combined(self,
+                 functions: Tuple[Callable, ...],
+                 dependencies: Tuple[Callable, ...] = ()) -> Callable:
+        # Keyed on the functions themselves, so every build() with the same
+        # callbacks reuses one combined function. The cache lives with the
+        # builder, so builders created per tenant or from closures do not
+        # keep their callbacks alive.
+        key = (functions, dependencies)
+        try:
+            combined = self.combined_cache.get(key)
+        except TypeError:
+            # Unhashable callbacks are combined without caching.
+            return combine(list(functions), dependencies)
+        if combined is None:
+            combined = self.combined_cache[key] = combine(
+                list(functions), dependencies)
+        return combined
+
+    def depends(self, func: Callable) -> params.Depends:
+        dependency = self.depends_cache.get(func)
+        if dependency is None:
+            dependency = self.depends_cache[func] = Depends(func)
+        return dependency
 
     def search_builder(self) -> Callable[[DecoratedCallable], DecoratedCallable]:
         def decorator(func: Callable) -> DecoratedCallable:
@@ -176,75 +284,89 @@ class ElasticsearchAPIQueryBuilder():
                                   start_from: int = 0,
                                   source: Union[List, Dict, str] = None,
                                   minimum_should_match: int = 1,
-                                  filters: List[Dict] = [],
-                                  matchers: List[Dict] = [],
-                                  highlighters: List[Dict] = [],
-                                  sorters: List[Dict] = [],
-                                  aggregations: List[Dict] = []) -> Dict:
-        query = {}
-        if len(filters) > 0 or len(matchers) > 0:
+                                  filters: List[Dict] = None,
+                                  matchers: List[Dict] = None,
+                                  highlighters: List[Dict] = None,
+                                  sorters: List[Dict] = None,
+                                  aggregations: List[Dict] = None) -> Dict:
+        if filters or matchers:
             bool_query = {}
-            query["bool"] = bool_query
-            if len(filters) > 0:
+            if filters:
                 bool_query["filter"] = filters
-            if len(matchers) > 0:
+            if matchers:
                 bool_query["should"] = matchers
                 bool_query["minimum_should_match"] = minimum_should_match
+            query = {"bool": bool_query}
         else:
-            query["match_all"] = {}
+            query = {"match_all": {}}
 
         body = {
             "query": query,
             "size": size,
             "from": start_from,
         }
-        if (source is not None):
+        if source is not None:
             body["_source"] = source
 
-        if len(highlighters) > 0:
-            highlight = {}
-            for h in highlighters:
-                highlight.update(h)
+        # A single dict is used as is, only several need merging.
+        if highlighters:
             body["highlight"] = {
-                "fields": highlight
+                "fields": highlighters[0] if len(highlighters) == 1
+                else merge_dicts(highlighters)
             }
 
-        if len(sorters) > 0:
+        if sorters:
             body["sort"] = sorters
 
-        if len(aggregations) > 0:
-            aggs = {}
-            for a in aggregations:
-                aggs.update(a)
-            body["aggs"] = aggs
+        if aggregations:
+            body["aggs"] = aggregations[0] if len(aggregations) == 1 \
+                else merge_dicts(aggregations)
 
         return body
 
     def build(self,
               source: Union[List, Dict, str] = None,
-              minimum_should_match: int = 1) -> Callable:
-
-        filters_functions = combine(self.filters)
-        matchers_functions = combine(self.matchers)
-        highlighters_functions = combine(self.highlighters)
-        sorters_functions = combine(self.sorters)
-        aggregations_functions = combine(self.aggregations)
-
-        def builder(
-                size: int = Depends(self.size_func),
-                start_from: int = Depends(self.start_from_func),
-                filters=Depends(filters_functions),
-                matchers=Depends(matchers_functions),
-                highlighters=Depends(highlighters_functions),
-                sorters=Depends(sorters_functions),
-                aggregations=Depends(aggregations_functions)
-        ):
-            filters = list(filter(lambda f: f is not None, filters))
-            matchers = list(filter(lambda f: f is not None, matchers))
-            highlighters = list(filter(lambda f: f is not None, highlighters))
-            sorters = list(filter(lambda f: f is not None, sorters))
-            aggregations = list(filter(lambda f: f is not None, aggregations))
-            return self.build_search_body(
+              minimum_should_match: int = 1,
+              track_total_hits: Union[bool, int] = None) -> Callable:
+
+        # The callbacks are frozen into tuples, so the built dependency does
+        # not change when callbacks are added to the builder afterwards, and
+        # they can be used as combined() keys directly.
+        groups = {
+            "filters": tuple(self.filters),
+            "matchers": tuple(self.matchers),
+            "highlighters": tuple(self.highlighters),
+            "sorters": tuple(self.sorters),
+            "aggregations": tuple(self.aggregations),
+        }
+
+        # A callback used in several groups is resolved as a sub-dependency,
+        # so FastAPI calls it only once per request.
+        group_callbacks = [{id(f): f for f in functions}
+                           for functions in groups.values()]
+        counts = Counter(i for callbacks in group_callbacks for i in callbacks)
+        shared = {i for callbacks in group_callbacks for i, f in callbacks.items()
+                  if counts[i] > 1 and isinstance(f, Hashable)}
+        dependencies = {
+            name: tuple(f for i, f in callbacks.items() if i in shared)
+            for name, callbacks in zip(groups, group_callbacks)
+        }
+
+        # Groups whose callbacks take no parameters are called directly by
+        # the builder, FastAPI would have nothing to extract for them.
+        parameterless = {
+            name: self.combined(functions)
+            for name, functions in groups.items()
+            if functions and not dependencies[name]
+            and not any(function_args(f) for f in functions)
+        }
+
+        def builder(size: int, start_from: int, **results: List):
+            for name, combined in parameterless.items():
+                results[name] = combined()
+            filters, matchers, highlighters, sorters, aggregations = (
+                results.get(name, []) for name in groups)
+            body = self.build_search_body(
                 size=size,
                 start_from=start_from,
                 source=source,
@@ -255,4 +377,27 @@ class ElasticsearchAPIQueryBuilder():
                 sorters=sorters,
                 aggregations=aggregations
             )
+            if track_total_hits is not None:
+                body["track_total_hits"] = track_total_hits
+            return body
+
+        # Groups without callbacks are left out of the signature, so
+        # FastAPI does not resolve a dependency that always returns [].
+        parameters = [
+            inspect.Parameter("size",
+                              inspect.Parameter.KEYWORD_ONLY,
+                              default=self.depends(self.size_func),
+                              annotation=int),
+            inspect.Parameter("start_from",
+                              inspect.Parameter.KEYWORD_ONLY,
+                              default=self.depends(self.start_from_func),
+                              annotation=int),
+        ]
+        for name, functions in groups.items():
+            if functions and name not in parameterless:
+                parameters.append(inspect.Parameter(
+                    name,
+                    inspect.Parameter.KEYWORD_ONLY,
+                    default=self.depends(self.combined(functions, dependencies[name]))))
+        builder.__signature__ = inspect.Signature(parameters)
         return builder
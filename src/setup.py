@@ -1,12 +1,13 @@
 import pathlib
-import os
 from setuptools import find_packages, setup
 
-HERE = os.environ["PWD"]
-with open(f"{HERE}/../README.md") as f:
-    README = f.read()
-with open(f"{HERE}/requirements.txt") as f:
-    required = f.read().splitlines()
+HERE = pathlib.Path(__file__).parent
+README = (HERE / "../README.md").read_text(encoding="utf-8")
+required = [
+    line.strip()
+    for line in (HERE / "requirements.txt").read_text(encoding="utf-8").splitlines()
+    if line.strip() and not line.strip().startswith("#")
+]
 
 setup(
     name="fastapi-elasticsearch",